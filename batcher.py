@@ -1,4 +1,13 @@
 import tensorflow as tf
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import queue
+import signal
+import time
+import traceback
+import json
+import pickle
 import glob
 import os
 import ntpath
@@ -56,6 +65,23 @@ class Vocab:
   
   def size(self):
     return self.count
+def load_vocab(vocab_file, max_size, use_cache=False):
+  """Builds the Vocab, or loads it from a pickle cache written next to the vocab file (rebuilt when the vocab file is newer)"""
+  cache_file = "{}.{}.pkl".format(vocab_file, max_size)
+  if use_cache and os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(vocab_file):
+    with open(cache_file, "rb") as f:
+      return pickle.load(f)
+  vocab = Vocab(vocab_file, max_size)
+  if use_cache:
+    try:
+      with open(cache_file + ".tmp", "wb") as f:
+        pickle.dump(vocab, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(cache_file + ".tmp", cache_file)
+    except OSError as e:
+      print("Warning : could not write the vocab cache %s : %s" % (cache_file, e))
+  return vocab
+
+
 class Data_Helper:
   def article_to_ids(article_words, vocab):
     ids = []
@@ -157,12 +183,12 @@ def _parse_function(example_proto):
   return parsed_example
   
   
-def example_generator(filenames, vocab, max_enc_len, max_dec_len, mode, batch_size):
+def example_generator(filenames, vocab, max_enc_len, max_dec_len, mode, batch_size, seed=None):
   
   raw_dataset = tf.data.TFRecordDataset(filenames)
   parsed_dataset = raw_dataset.map(_parse_function)
   if mode == "train":
-    parsed_dataset = parsed_dataset.shuffle(1000, reshuffle_each_iteration=True).repeat()
+    parsed_dataset = parsed_dataset.shuffle(1000, seed=seed, reshuffle_each_iteration=True).repeat()
 
   for raw_record in parsed_dataset:
     
@@ -270,9 +296,368 @@ def batch_generator(generator, filenames, vocab, max_enc_len, max_dec_len, batch
   return dataset
 
 
-def batcher(data_path, vocab, hpm):
+def _slot_layout(batch_size, max_enc_len, max_dec_len):
+  """Returns the (name, shape, offset) of every padded int32 array stored in a shared memory slot, and the slot size in int32 units"""
+  shapes = [("enc_input", (batch_size, max_enc_len)),
+            ("enc_input_extend_vocab", (batch_size, max_enc_len)),
+            ("dec_input", (batch_size, max_dec_len)),
+            ("target", (batch_size, max_dec_len)),
+            ("enc_len", (batch_size,)),
+            ("dec_len", (batch_size,))]
+  layout = []
+  offset = 0
+  for name, shape in shapes:
+    layout.append((name, shape, offset))
+    offset += int(np.prod(shape))
+  return layout, offset
+
+
+def _slot_arrays(buf, layout):
+  """NumPy views over a shared memory slot (no copy)"""
+  return {name : np.ndarray(shape, dtype=np.int32, buffer=buf, offset=offset*4) for name, shape, offset in layout}
+
+
+def _parent_alive():
+  parent = mp.parent_process()
+  return parent is None or parent.is_alive()
+
+
+def _get_free_slot(free_slots, stop):
+  """Waits for a free slot, returns None when the worker must stop (stop event set, or main process dead without calling close)"""
+  # free_slots is a SimpleQueue (no timeout on get), the worker is its only reader so a non empty queue can't be emptied under it
+  while not stop.is_set() and _parent_alive():
+    if not free_slots.empty():
+      return free_slots.get()
+    time.sleep(0.01)
+  return None
+
+
+def _loader_worker(worker_id, filenames, vocab, hpm, slot_names, free_slots, ready, stop, seed):
+  """Worker process : tokenizes its share of the tfrecords files and writes padded batches into its shared memory slots.
+  Messages sent on the ready queue are (worker_id, seq, slot, payload) :
+    slot is not None : a batch has been written in this slot, payload holds the string fields
+    slot is None and payload is None : the worker has no more batches
+    slot is None and payload is a string : the worker failed, payload is the traceback"""
+  signal.signal(signal.SIGINT, signal.SIG_IGN) # KeyboardInterrupt is handled by the main process
+  batch_size = hpm["batch_size"]
+  layout, _ = _slot_layout(batch_size, hpm["max_enc_len"], hpm["max_dec_len"])
+  shms = [shared_memory.SharedMemory(name=name) for name in slot_names]
+  arrays = [_slot_arrays(shm.buf, layout) for shm in shms]
+  a = None
+  seq = 0
+  try:
+    examples = []
+    for example in example_generator(filenames, vocab, hpm["max_enc_len"], hpm["max_dec_len"], hpm["mode"], batch_size, seed=seed):
+      examples.append(example)
+      if len(examples) < batch_size:
+        continue
+      slot = _get_free_slot(free_slots, stop)
+      if slot is None:
+        if not _parent_alive():
+          ready.cancel_join_thread() # nobody reads the unsent messages anymore, they must not block the exit
+        return
+      a = arrays[slot]
+      for name in ["enc_input", "enc_input_extend_vocab", "dec_input", "target"]:
+        a[name].fill(1) # pad id
+      for i, ex in enumerate(examples):
+        a["enc_input"][i, :ex["enc_len"]] = ex["enc_input"]
+        a["enc_input_extend_vocab"][i, :ex["enc_len"]] = ex["enc_input_extend_vocab"]
+        a["dec_input"][i, :ex["dec_len"]] = ex["dec_input"]
+        a["target"][i, :ex["dec_len"]] = ex["target"]
+        a["enc_len"][i] = ex["enc_len"]
+        a["dec_len"][i] = ex["dec_len"]
+      strings = {"article_oovs" : [ex["article_oovs"] for ex in examples],
+                 "article" : [ex["article"] for ex in examples],
+                 "abstract" : [ex["abstract"] for ex in examples]}
+      ready.put((worker_id, seq, slot, strings))
+      seq += 1
+      examples = [] # the last incomplete batch is dropped, as with drop_remainder=True
+    ready.put((worker_id, seq, None, None))
+  except Exception:
+    ready.put((worker_id, seq, None, traceback.format_exc()))
+  finally:
+    arrays, a = None, None # the views must be released before closing the shared memory
+    for shm in shms:
+      shm.close()
+
+
+def _batch_to_tensors(a, strings):
+  """Builds the batcher output from padded int32 arrays (see _slot_layout) and the string fields of a batch"""
+  enc_width = int(a["enc_len"].max())
+  max_oov_len = max(len(oovs) for oovs in strings["article_oovs"])
+  article_oovs = [list(oovs) + [""]*(max_oov_len-len(oovs)) for oovs in strings["article_oovs"]]
+  return ({"enc_input" : tf.constant(a["enc_input"][:, :enc_width]),
+          "extended_enc_input" : tf.constant(a["enc_input_extend_vocab"][:, :enc_width]),
+          "article_oovs" : tf.constant(article_oovs, dtype=tf.string, shape=[len(article_oovs), max_oov_len]),
+          "enc_len" : tf.constant(a["enc_len"]),
+          "article" : tf.constant(strings["article"], dtype=tf.string),
+          "max_oov_len" : tf.constant(max_oov_len, dtype=tf.int32)},
+
+         {"dec_input" : tf.constant(a["dec_input"]),
+         "dec_target" : tf.constant(a["target"]),
+         "dec_len" : tf.constant(a["dec_len"]),
+         "abstract" : tf.constant(strings["abstract"], dtype=tf.string)})
+
+
+class ParallelBatcher:
+  """Batcher fanning the tfrecords files out to a pool of worker processes.
+  The workers tokenize, map the words to ids and pad the batches directly into shared memory slots (prefetch slots per worker, used as a ring buffer).
+  A slot is recycled when the next batch is requested, so a batch must not be kept after the next one has been read.
+  With deterministic=True, the batches are read from the workers in a fixed round robin order and the shuffle is seeded, so two runs see the same batches.
+  The workers ignore SIGINT : a KeyboardInterrupt is raised in the main process only (train_model saves a checkpoint) and the pool is shut down when the iteration stops."""
+
+  def __init__(self, filenames, vocab, hpm, num_workers, prefetch=2, deterministic=False):
+    assert prefetch >= 1, "Each data loading worker needs at least one shared memory slot"
+    self.filenames = sorted(filenames)
+    self.vocab = vocab
+    self.hpm = hpm
+    self.num_workers = min(num_workers, len(self.filenames))
+    self.prefetch = prefetch
+    self.deterministic = deterministic
+    self.layout, self.slot_size = _slot_layout(hpm["batch_size"], hpm["max_enc_len"], hpm["max_dec_len"])
+    self._processes = []
+    self._shms = []
+
+  def _start(self):
+    ctx = mp.get_context("spawn") # forking a process which has already initialized tensorflow is not safe
+    self._stop = ctx.Event()
+    self._ready = ctx.Queue()
+    self._free_slots = []
+    self._arrays = []
+    cuda_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    os.environ["CUDA_VISIBLE_DEVICES"] = "" # the workers must not allocate GPU memory
+    try:
+      for worker_id in range(self.num_workers):
+        shms = [shared_memory.SharedMemory(create=True, size=self.slot_size*4) for _ in range(self.prefetch)]
+        free_slots = ctx.SimpleQueue() # no feeder thread, which could block the main process at exit
+        for slot in range(self.prefetch):
+          free_slots.put(slot)
+        seed = worker_id if self.deterministic else None
+        p = ctx.Process(target=_loader_worker, args=(worker_id, self.filenames[worker_id::self.num_workers], self.vocab, self.hpm,
+                                                     [shm.name for shm in shms], free_slots, self._ready, self._stop, seed), daemon=True)
+        p.start()
+        self._shms.append(shms)
+        self._arrays.append([_slot_arrays(shm.buf, self.layout) for shm in shms])
+        self._free_slots.append(free_slots)
+        self._processes.append(p)
+    finally:
+      if cuda_devices is None:
+        del os.environ["CUDA_VISIBLE_DEVICES"]
+      else:
+        os.environ["CUDA_VISIBLE_DEVICES"] = cuda_devices
+
+  def _get(self):
+    while True:
+      try:
+        return self._ready.get(timeout=1.0)
+      except queue.Empty:
+        for worker_id, p in enumerate(self._processes):
+          if not p.is_alive() and p.exitcode != 0:
+            raise RuntimeError("Loader worker %i died with exit code %s" % (worker_id, p.exitcode))
+
+  def _next_message(self, active, turn, seqs, pending):
+    if not self.deterministic:
+      return self._get()
+    key = (active[turn], seqs[active[turn]])
+    while key not in pending:
+      msg = self._get()
+      pending[(msg[0], msg[1])] = msg
+    return pending.pop(key)
+
+  def __iter__(self):
+    self._start()
+    active = list(range(self.num_workers))
+    seqs = [0] * self.num_workers
+    pending = {}
+    turn = 0
+    in_use = None
+    try:
+      while active:
+        if in_use is not None:
+          # the previous batch has been consumed, its slot is given back before waiting for the next one
+          self._free_slots[in_use[0]].put(in_use[1])
+          in_use = None
+        worker_id, seq, slot, payload = self._next_message(active, turn, seqs, pending)
+        seqs[worker_id] += 1
+        if slot is None:
+          if payload is not None:
+            raise RuntimeError("Loader worker %i failed :\n%s" % (worker_id, payload))
+          active.remove(worker_id)
+          turn = turn % len(active) if active else 0
+          continue
+        in_use = (worker_id, slot)
+        turn = (turn + 1) % len(active)
+        yield _batch_to_tensors(self._arrays[worker_id][slot], payload)
+    finally:
+      self.close()
+
+  def close(self):
+    """Stops the workers and frees the shared memory. Safe to call several times."""
+    if not self._processes:
+      return
+    self._stop.set()
+    # the unread messages are drained, otherwise the workers block on exit until their queue feeder thread has flushed them
+    deadline = time.time() + 5
+    while any(p.is_alive() for p in self._processes) and time.time() < deadline:
+      try:
+        self._ready.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    for p in self._processes:
+      if p.is_alive():
+        p.terminate()
+      p.join()
+    self._ready.close()
+    self._ready.cancel_join_thread()
+    for free_slots in self._free_slots:
+      if hasattr(free_slots, "close"): # SimpleQueue.close was added in python 3.9
+        free_slots.close()
+    self._free_slots = []
+    self._arrays = [] # the views must be released before closing the shared memory
+    for shms in self._shms:
+      for shm in shms:
+        shm.unlink()
+        try:
+          shm.close()
+        except BufferError: # a tensor still aliases the slot, the mapping is released with it
+          pass
+    self._processes = []
+    self._shms = []
+
+
+PACKED_META = "packed_meta.json"
+
+
+def pack_corpus(data_path, out_dir, vocab, hpm):
+  """Converts the tfrecords files of data_path into a packed corpus :
+    article_ids.bin : flat int32 array of the enc_input_extend_vocab ids of all the articles
+    abstract_ids.bin : flat int32 array of the extended vocab ids of all the abstracts (not truncated, no start/stop ids)
+    strings.bin : flat utf-8 bytes of the article, abstract and space separated article_oovs of every example
+    index.npy : int64 array of shape (num_examples+1, 5), the offsets of every example in the files above
+    packed_meta.json : number of examples, vocab size and max_enc_len used to build the corpus
+  The ids without the extended vocab are recovered by mapping the ids >= vocab.size() to [UNK]"""
+  os.makedirs(out_dir, exist_ok=True)
+  filenames = sorted(glob.glob("{}/*.tfrecords".format(data_path)))
+  index = [[0, 0, 0, 0, 0]]
+  n_art, n_abs, n_str = 0, 0, 0
+  with open(os.path.join(out_dir, "article_ids.bin"), "wb") as f_art, \
+       open(os.path.join(out_dir, "abstract_ids.bin"), "wb") as f_abs, \
+       open(os.path.join(out_dir, "strings.bin"), "wb") as f_str:
+    for ex in example_generator(filenames, vocab, hpm["max_enc_len"], hpm["max_dec_len"], "pack", 1):
+      abs_ids_extend_vocab = Data_Helper.abstract_to_ids(ex["abstract"].split(), vocab, ex["article_oovs"])
+      np.asarray(ex["enc_input_extend_vocab"], dtype=np.int32).tofile(f_art)
+      np.asarray(abs_ids_extend_vocab, dtype=np.int32).tofile(f_abs)
+      article, abstract, oovs = [t.encode() for t in [ex["article"], ex["abstract"], " ".join(ex["article_oovs"])]]
+      f_str.write(article + abstract + oovs)
+      index[-1][3] = n_str + len(article)
+      index[-1][4] = n_str + len(article) + len(abstract)
+      n_art += len(ex["enc_input_extend_vocab"])
+      n_abs += len(abs_ids_extend_vocab)
+      n_str += len(article) + len(abstract) + len(oovs)
+      index.append([n_art, n_abs, n_str, 0, 0])
+  np.save(os.path.join(out_dir, "index.npy"), np.asarray(index, dtype=np.int64))
+  with open(os.path.join(out_dir, PACKED_META), "w") as f:
+    json.dump({"num_examples" : len(index)-1, "vocab_size" : vocab.size(), "max_enc_len" : hpm["max_enc_len"]}, f)
+  print("Packed %i examples in %s" % (len(index)-1, out_dir))
+
+
+class PackedBatcher:
+  """Batcher sampling a packed corpus (see pack_corpus) through memory maps, nothing is read before it is needed.
+  In train mode, every epoch is a global shuffle of the corpus, seeded by (seed, epoch). The batch of a step thus only depends on the seed and
+  the step number. ckpt.step counts the batches already trained (see train_model), so a run restored at ckpt.step starts with the first batch
+  the interrupted run did not train and then sees the same batches as an uninterrupted one.
+  The articles can be truncated to a smaller max_enc_len than the one used to pack the corpus : the article OOVs cut off are dropped and the
+  abstract words which were copied from them are mapped to [UNK], as example_generator does.
+  In the other modes, the examples are read in order, and in test and eval modes each one is repeated batch_size times (beam search)."""
+
+  def __init__(self, packed_dir, vocab, hpm, start_step=0, seed=0):
+    with open(os.path.join(packed_dir, PACKED_META)) as f:
+      meta = json.load(f)
+    assert meta["vocab_size"] == vocab.size(), "The packed corpus was built with a vocab of %i words, not %i" % (meta["vocab_size"], vocab.size())
+    assert hpm["max_enc_len"] <= meta["max_enc_len"], "The packed corpus articles are truncated to %i words" % meta["max_enc_len"]
+    assert meta["num_examples"] > 0, "The packed corpus is empty"
+    self.num_examples = meta["num_examples"]
+    self.vocab = vocab
+    self.hpm = hpm
+    self.start_step = start_step
+    self.seed = seed
+    self.index = np.load(os.path.join(packed_dir, "index.npy"), mmap_mode="r")
+    self.article_ids = np.memmap(os.path.join(packed_dir, "article_ids.bin"), dtype=np.int32, mode="r")
+    self.abstract_ids = np.memmap(os.path.join(packed_dir, "abstract_ids.bin"), dtype=np.int32, mode="r")
+    self.strings = np.memmap(os.path.join(packed_dir, "strings.bin"), dtype=np.uint8, mode="r")
+
+  def _example_order(self):
+    batch_size = self.hpm["batch_size"]
+    if self.hpm["mode"] != "train":
+      repeat = batch_size if self.hpm["mode"] in ["test", "eval"] else 1
+      for i in range(self.num_examples):
+        for _ in range(repeat):
+          yield i
+      return
+    position = self.start_step * batch_size
+    epoch, offset = divmod(position, self.num_examples)
+    while True:
+      order = np.random.default_rng([self.seed, epoch]).permutation(self.num_examples)
+      for i in order[offset:]:
+        yield int(i)
+      epoch += 1
+      offset = 0
+
+  def _fill(self, a, row, i):
+    unk_id = self.vocab.word_to_id(Vocab.UNKNOWN_TOKEN)
+    start_decoding = self.vocab.word_to_id(Vocab.START_DECODING)
+    stop_decoding = self.vocab.word_to_id(Vocab.STOP_DECODING)
+    art = self.index[i, 0], self.index[i+1, 0]
+    abst = self.index[i, 1], self.index[i+1, 1]
+    enc_input_extend_vocab = np.asarray(self.article_ids[art[0]:art[1]][:self.hpm["max_enc_len"]])
+    abs_ids_extend_vocab = np.asarray(self.abstract_ids[abst[0]:abst[1]])
+    # the OOVs are numbered by first occurrence, so the ones still in the truncated article are the num_oovs first ones
+    num_oovs = int(enc_input_extend_vocab.max()) - self.vocab.size() + 1 if len(enc_input_extend_vocab) else 0
+    num_oovs = max(num_oovs, 0)
+    abs_ids_extend_vocab = np.where(abs_ids_extend_vocab >= self.vocab.size() + num_oovs, unk_id, abs_ids_extend_vocab)
+    abs_ids = np.where(abs_ids_extend_vocab >= self.vocab.size(), unk_id, abs_ids_extend_vocab)
+    dec_input, _ = Data_Helper.get_dec_inp_targ_seqs(abs_ids.tolist(), self.hpm["max_dec_len"], start_decoding, stop_decoding)
+    _, target = Data_Helper.get_dec_inp_targ_seqs(abs_ids_extend_vocab.tolist(), self.hpm["max_dec_len"], start_decoding, stop_decoding)
+    enc_len, dec_len = len(enc_input_extend_vocab), len(dec_input)
+    a["enc_input"][row, :enc_len] = np.where(enc_input_extend_vocab >= self.vocab.size(), unk_id, enc_input_extend_vocab)
+    a["enc_input_extend_vocab"][row, :enc_len] = enc_input_extend_vocab
+    a["dec_input"][row, :dec_len] = dec_input
+    a["target"][row, :dec_len] = target
+    a["enc_len"][row] = enc_len
+    a["dec_len"][row] = dec_len
+    return num_oovs
+
+  def _strings(self, i):
+    str_start, abstract_start, oovs_start, str_end = self.index[i, 2], self.index[i, 3], self.index[i, 4], self.index[i+1, 2]
+    decode = lambda start, end: self.strings[start:end].tobytes().decode()
+    return decode(str_start, abstract_start), decode(abstract_start, oovs_start), decode(oovs_start, str_end).split()
+
+  def __iter__(self):
+    batch_size = self.hpm["batch_size"]
+    layout, _ = _slot_layout(batch_size, self.hpm["max_enc_len"], self.hpm["max_dec_len"])
+    order = self._example_order()
+    while True:
+      examples = [i for _, i in zip(range(batch_size), order)]
+      if len(examples) < batch_size: # drop_remainder=True
+        return
+      a = {name : np.ones(shape, dtype=np.int32) for name, shape, _ in layout} # 1 is the pad id
+      strings = {"article" : [], "abstract" : [], "article_oovs" : []}
+      for row, i in enumerate(examples):
+        num_oovs = self._fill(a, row, i)
+        article, abstract, article_oovs = self._strings(i)
+        strings["article"].append(article)
+        strings["abstract"].append(abstract)
+        strings["article_oovs"].append(article_oovs[:num_oovs])
+      yield _batch_to_tensors(a, strings)
+
+
+def batcher(data_path, vocab, hpm, start_step=0):
   
+  if os.path.isfile(os.path.join(data_path, PACKED_META)):
+    return PackedBatcher(data_path, vocab, hpm, start_step, hpm.get("seed", 0))
   filenames = glob.glob("{}/*.tfrecords".format(data_path))
+  if hpm.get("num_workers", 0) > 0:
+    return ParallelBatcher(filenames, vocab, hpm, hpm["num_workers"], hpm.get("prefetch_batches", 2), hpm.get("deterministic", False))
   dataset = batch_generator(example_generator, filenames, vocab, hpm["max_enc_len"], hpm["max_dec_len"], hpm["batch_size"], hpm["mode"] )
 
   return dataset
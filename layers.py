@@ -25,19 +25,25 @@ class BahdanauAttention(tf.keras.layers.Layer):
     super(BahdanauAttention, self).__init__()
     self.W1 = tf.keras.layers.Dense(units)
     self.W2 = tf.keras.layers.Dense(units)
+    self.W_c = tf.keras.layers.Dense(units) # only built when the attention is called with a coverage vector
     self.V = tf.keras.layers.Dense(1)
 
-  def call(self, query, values):
+  def call(self, query, values, coverage=None):
     # hidden shape == (batch_size, hidden size)
     # hidden_with_time_axis shape == (batch_size, 1, hidden size)
     # we are doing this to perform addition to calculate the score
     hidden_with_time_axis = tf.expand_dims(query, 1)
 
+    # features shape == (batch_size, max_length, units)
+    features = self.W1(values) + self.W2(hidden_with_time_axis)
+    if coverage is not None:
+      # coverage shape == (batch_size, max_length), sum of the attention weights of the previous decoder steps
+      features += self.W_c(tf.expand_dims(coverage, -1))
+
     # score shape == (batch_size, max_length, 1)
     # we get 1 at the last axis because we are applying score to self.V
     # the shape of the tensor before applying self.V is (batch_size, max_length, units)
-    score = self.V(tf.nn.tanh(
-        self.W1(values) + self.W2(hidden_with_time_axis)))
+    score = self.V(tf.nn.tanh(features))
 
     # attention_weights shape == (batch_size, max_length, 1)
     attention_weights = tf.nn.softmax(score, axis=1)
@@ -62,7 +68,11 @@ class Decoder(tf.keras.layers.Layer):
     self.fc = tf.keras.layers.Dense(vocab_size, activation=tf.keras.activations.softmax)
     
 
-  def call(self, x, hidden, enc_output, context_vector):
+  def gather_shortlist(self, shortlist_ids):
+    """Gathers the output projection weights of the shortlisted words (done once per article at inference)"""
+    return shortlist_ids, tf.gather(self.fc.kernel, shortlist_ids, axis=1), tf.gather(self.fc.bias, shortlist_ids)
+
+  def call(self, x, hidden, enc_output, context_vector, shortlist=None):
     # enc_output shape == (batch_size, max_length, hidden_size)
     
 
@@ -78,8 +88,12 @@ class Decoder(tf.keras.layers.Layer):
     # output shape == (batch_size * 1, hidden_size)
     output = tf.reshape(output, (-1, output.shape[2]))
 
-    # output shape == (batch_size, vocab)
-    out = self.fc(output)
+    # output shape == (batch_size, vocab), or (batch_size, shortlist_size) with a shortlist
+    if shortlist is None:
+      out = self.fc(output)
+    else:
+      _, kernel, bias = shortlist
+      out = tf.nn.softmax(tf.matmul(output, kernel) + bias)
 
     return x, out, state
   
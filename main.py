@@ -1,7 +1,6 @@
-import tensorflow as tf
 import argparse
-from train_test_eval import train, test_and_save, evaluate
 import os
+import time
 
 def main():
   parser = argparse.ArgumentParser()
@@ -11,6 +10,16 @@ def main():
   parser.add_argument("--min_dec_steps", default=30, help="Minimum number of words of the predicted abstract", type=int)
   parser.add_argument("--batch_size", default=16, help="batch size", type=int)
   parser.add_argument("--beam_size", default=4, help="beam size for beam search decoding (must be equal to batch size in decode mode)", type=int)
+  parser.add_argument("--length_penalty", default="avg", help="Length penalty used to rank the beam search hypothesises : avg (average log prob) or gnmt ((5+length)/6)^lp_alpha", type=str)
+  parser.add_argument("--lp_alpha", default=0.6, help="Exponent of the gnmt length penalty", type=float)
+  parser.add_argument("--beam_prune_threshold", default=0., help="Drop the live hypothesises whose score is more than this below the best finished hypothesis (0 to disable)", type=float)
+  parser.add_argument("--beam_early_stopping", help="Stop the beam search when no live hypothesis can beat the best finished one under the length penalty", action="store_true")
+  parser.add_argument("--no_repeat_ngram_size", default=0, help="Forbid the beam search to repeat an n-gram of this size (0 to disable)", type=int)
+  parser.add_argument("--shortlist_size", default=0, help="In beam search, restrict the generator softmax to this many most frequent words plus the article words (0 to use the whole vocab)", type=int)
+  parser.add_argument("--fast_decode", default="greedy", help="Decoding used in fast mode : greedy or topk (top k sampling)", type=str)
+  parser.add_argument("--top_k", default=5, help="Number of words sampled from in topk fast decoding", type=int)
+  parser.add_argument("--fast_margin", default=0., help="In fast mode, articles whose average margin between the two most likely words is below this are decoded with beam search (0 to disable)", type=float)
+  parser.add_argument("--compare_beam", help="In fast mode, also decode the articles with beam search and print both latencies and ROUGE scores", action="store_true")
   parser.add_argument("--vocab_size", default=50000, help="Vocabulary size", type=int)
   parser.add_argument("--embed_size", default=128, help="Words embeddings dimension", type=int)
   parser.add_argument("--enc_units", default=256, help="Encoder GRU cell units number", type=int)
@@ -19,28 +28,42 @@ def main():
   parser.add_argument("--learning_rate", default=0.15, help="Learning rate", type=float)
   parser.add_argument("--adagrad_init_acc", default=0.1, help="Adagrad optimizer initial accumulator value. Please refer to the Adagrad optimizer API documentation on tensorflow site for more details.", type=float)
   parser.add_argument("--max_grad_norm",default=0.8, help="Gradient norm above which gradients must be clipped", type=float)
+  parser.add_argument("--is_coverage", help="Use the coverage mechanism (coverage vector in the attention and coverage loss)", action="store_true")
+  parser.add_argument("--cov_loss_wt", default=1.0, help="Weight of the coverage loss in the training loss", type=float)
   parser.add_argument("--checkpoints_save_steps", default=10000, help="Save checkpoints every N steps", type=int)
   parser.add_argument("--max_steps", default=10000, help="Max number of iterations", type=int)
   parser.add_argument("--num_to_test", default=5, help="Number of examples to test", type=int)
   parser.add_argument("--max_num_to_eval", default=5, help="Max number of examples to evaluate", type=int)
-  parser.add_argument("--mode", help="training, eval or test options", default="", type=str)
+  parser.add_argument("--mode", help="training, eval, test, fast or pack options", default="", type=str)
   parser.add_argument("--model_path", help="Path to a specific model", default="", type=str)
   parser.add_argument("--checkpoint_dir", help="Checkpoint directory", default="", type=str)
   parser.add_argument("--test_save_dir", help="Directory in which we store the decoding results", default="", type=str)
   parser.add_argument("--data_dir",  help="Data Folder", default="", type=str)
   parser.add_argument("--vocab_path", help="Vocab path", default="", type=str)
+  parser.add_argument("--vocab_cache", help="Cache the parsed vocab in a pickle file next to vocab_path", action="store_true")
   parser.add_argument("--log_file", help="File in which to redirect console outputs", default="", type=str)
+  parser.add_argument("--num_workers", default=0, help="Number of data loading worker processes (0 uses the tf.data pipeline in the main process)", type=int)
+  parser.add_argument("--prefetch_batches", default=2, help="Number of shared memory batches each data loading worker can fill ahead", type=int)
+  parser.add_argument("--deterministic", help="With num_workers > 0, read the batches in a fixed order with a seeded shuffle", action="store_true")
+  parser.add_argument("--seed", default=0, help="Seed of the global shuffle of a packed corpus", type=int)
+  parser.add_argument("--pack_dir", help="Directory in which the packed corpus is written in pack mode (use it as data_dir afterwards)", default="", type=str)
 
 
   args = parser.parse_args()
   params = vars(args)
   print(params)
 
-  assert params["mode"], "mode is required. train, test or eval option"
-  assert params["mode"] in ["train", "test", "eval"], "The mode must be train , test or eval"
+  assert params["mode"], "mode is required. train, test, eval, fast or pack option"
+  assert params["mode"] in ["train", "test", "eval", "fast", "pack"], "The mode must be train , test, eval, fast or pack"
   assert os.path.exists(params["data_dir"]), "data_dir doesn't exist"
   assert os.path.isfile(params["vocab_path"]), "vocab_path doesn't exist"
+  assert params["length_penalty"] in ["avg", "gnmt"], "The length penalty must be avg or gnmt"
+  assert params["fast_decode"] in ["greedy", "topk"], "The fast decoding must be greedy or topk"
 
+  # tensorflow, rouge and tqdm are only imported once the arguments are checked, by the mode which needs them
+  t0 = time.time()
+  from train_test_eval import train, test_and_save, evaluate, fast_evaluate, pack
+  print("Imported the modules in {:.2f}s".format(time.time()-t0))
 
   if params["mode"] == "train":
     train( params)
@@ -48,6 +71,10 @@ def main():
     test_and_save(params)
   elif params["mode"] == "eval":
     evaluate(params)
+  elif params["mode"] == "fast":
+    fast_evaluate(params)
+  elif params["mode"] == "pack":
+    pack(params)
   
   
 if __name__ =="__main__":
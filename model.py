@@ -17,23 +17,37 @@ class PGN(tf.keras.Model):
     enc_output, enc_hidden = self.encoder(enc_inp, enc_hidden)
     return enc_hidden, enc_output
     
-  def call(self, enc_output, dec_hidden, enc_inp, enc_extended_inp,  dec_inp, batch_oov_len):
+  def warm_up(self):
+    """Builds the variables with a dummy batch, so that a checkpoint restore is applied at once and the first real step doesn't build the layers"""
+    dummy_inp = tf.ones((self.params["batch_size"], 1), dtype=tf.int32)
+    enc_hidden, enc_output = self.call_encoder(dummy_inp)
+    self(enc_output, enc_hidden, dummy_inp, dummy_inp, dummy_inp, tf.constant(0))
+    
+  def call(self, enc_output, dec_hidden, enc_inp, enc_extended_inp,  dec_inp, batch_oov_len, coverage=None, shortlist=None):
     
     predictions = []
     attentions = []
     p_gens = []
-    context_vector, _ = self.attention(dec_hidden, enc_output)
+    coverage_losses = []
+    if self.params["is_coverage"] and coverage is None:
+      coverage = tf.zeros(tf.shape(enc_output)[:2]) # shape = (batch_size, enc_len)
+    context_vector, _ = self.attention(dec_hidden, enc_output, coverage)
     for t in range(dec_inp.shape[1]):
-      dec_x, pred, dec_hidden = self.decoder(tf.expand_dims(dec_inp[:, t],1), dec_hidden, enc_output, context_vector)
-      context_vector, attn = self.attention(dec_hidden, enc_output)
+      dec_x, pred, dec_hidden = self.decoder(tf.expand_dims(dec_inp[:, t],1), dec_hidden, enc_output, context_vector, shortlist)
+      context_vector, attn = self.attention(dec_hidden, enc_output, coverage)
       p_gen = self.pointer(context_vector, dec_hidden, tf.squeeze(dec_x, axis=1))
+      if coverage is not None:
+        # the forward pass only keeps the running sum (the gradient tape still holds the coverage of every step for tf.minimum)
+        coverage_losses.append(tf.reduce_sum(tf.minimum(attn, coverage), axis=1)) # shape = (batch_size)
+        coverage = coverage + attn
       
       predictions.append(pred)
       attentions.append(attn)
       p_gens.append(p_gen)
-    final_dists = _calc_final_dist( enc_extended_inp, predictions, attentions, p_gens, batch_oov_len, self.params["vocab_size"], self.params["batch_size"])
+    shortlist_ids = shortlist[0] if shortlist is not None else None
+    final_dists = _calc_final_dist( enc_extended_inp, predictions, attentions, p_gens, batch_oov_len, self.params["vocab_size"], self.params["batch_size"], shortlist_ids)
+    coverage_losses = tf.stack(coverage_losses, 1) if coverage_losses else None # shape = (batch_size, dec_len)
     if self.params["mode"] == "train":
-      return tf.stack(final_dists, 1), dec_hidden  # predictions_shape = (batch_size, dec_len, vocab_size) with dec_len = 1 in pred mode
+      return tf.stack(final_dists, 1), dec_hidden, coverage_losses  # predictions_shape = (batch_size, dec_len, vocab_size) with dec_len = 1 in pred mode
     else:
-      return tf.stack(final_dists, 1), dec_hidden, context_vector, tf.stack(attentions, 1), tf.stack(p_gens, 1)
-  
\ No newline at end of file
+      return tf.stack(final_dists, 1), dec_hidden, context_vector, tf.stack(attentions, 1), tf.stack(p_gens, 1), coverage
@@ -1,10 +1,11 @@
 import tensorflow as tf
 import numpy as np
+import time
 from batcher import Data_Helper
 
 def beam_decode(model, batch, vocab, params):
   
-  def decode_onestep(batch, enc_outputs, dec_state, dec_input):
+  def decode_onestep(batch, enc_outputs, dec_state, dec_input, cov_vec, banned_ids, shortlist):
     """
         Method to decode the output step by step (used for beamSearch decoding)
         Args:
@@ -13,42 +14,51 @@ def beam_decode(model, batch, vocab, params):
             enc_outputs : hiddens outputs computed by the encoder LSTM
             dec_state : beam_size-many list of decoder previous state, LSTMStateTuple objects, shape = [beam_size, 2, hidden_size]
             dec_input : decoder_input, the previous decoded batch_size-many words, shape = [beam_size, embed_size]
-            cov_vec : beam_size-many list of previous coverage vector
+            cov_vec : beam_size-many list of previous coverage vector, shape = [beam_size, enc_len] (None if coverage is disabled)
+            banned_ids : list of [hypothesis index, token id] pairs whose probability is masked to zero (n-gram blocking)
+            shortlist : (ids, kernel, bias) of the words the generator softmax is restricted to (None to use the whole vocab)
         Returns: A dictionary of the results of all the ops computations (see below for more details)
     """
     # dictionary of all the ops that will be computed
-    final_dists, dec_hidden, context_vector, attentions, p_gens = model(enc_outputs, dec_state,batch[0]["enc_input"], batch[0]["extended_enc_input"], dec_input, batch[0]["max_oov_len"])
-    top_k_probs, top_k_ids = tf.nn.top_k(tf.squeeze(final_dists), k = params["beam_size"]*2)
+    final_dists, dec_hidden, context_vector, attentions, p_gens, coverage = model(enc_outputs, dec_state,batch[0]["enc_input"], batch[0]["extended_enc_input"], dec_input, batch[0]["max_oov_len"], cov_vec, shortlist)
+    final_dists = tf.squeeze(final_dists)
+    if banned_ids:
+      final_dists = tf.tensor_scatter_nd_update(final_dists, banned_ids, tf.zeros(len(banned_ids)))
+    top_k_probs, top_k_ids = tf.nn.top_k(final_dists, k = params["beam_size"]*2)
     top_k_log_probs = tf.math.log(top_k_probs)
     results = {"last_context_vector" : context_vector,
               "dec_state" : dec_hidden,
               "attention_vec" :attentions,
                 "top_k_ids" : top_k_ids,
                 "top_k_log_probs" : top_k_log_probs,
-                "p_gen" : p_gens}
+                "p_gen" : p_gens,
+                "coverage" : coverage}
     return results
 
 
   # nested class
   class Hypothesis:
     """ Class designed to hold hypothesises throughout the beamSearch decoding """
-    def __init__(self, tokens, log_probs, state, attn_dists, p_gens):
+    def __init__(self, tokens, log_probs, state, attn_dists, p_gens, coverage):
       self.tokens = tokens # list of all the tokens from time 0 to the current time step t
       self.log_probs = log_probs # list of the log probabilities of the tokens of the tokens
       self.state = state # decoder state after the last token decoding
       self.attn_dists = attn_dists # attention dists of all the tokens
       self.p_gens = p_gens # generation probability of all the tokens
+      self.coverage = coverage # sum of the attention dists of all the tokens (None if coverage is disabled)
       self.abstract = ""
       self.text = ""
       self.real_abstract = ""
+      self.decode_steps = 0 # number of decoding steps run by the beam search which produced this hypothesis
 
-    def extend(self, token, log_prob, state, attn_dist, p_gen):
+    def extend(self, token, log_prob, state, attn_dist, p_gen, coverage):
       """Method to extend the current hypothesis by adding the next decoded toekn and all the informations associated with it"""
       return Hypothesis(tokens = self.tokens + [token], # we add the decoded token
                         log_probs = self.log_probs + [log_prob], # we add the log prob of the decoded token
                         state = state, # we update the state
                         attn_dists = self.attn_dists + [attn_dist], # we  add the attention dist of the decoded token
-                        p_gens = self.p_gens + [p_gen] # we add the p_gen 
+                        p_gens = self.p_gens + [p_gen], # we add the p_gen 
+                        coverage = coverage # we update the coverage vector
                         )
 
     @property
@@ -63,35 +73,74 @@ def beam_decode(model, batch, vocab, params):
     def avg_log_prob(self):
       return self.tot_log_prob/len(self.tokens)
 
+    @property
+    def score(self):
+      """Log prob normalized by the length penalty, used to rank the hypothesises"""
+      return self.tot_log_prob/length_penalty(len(self.tokens))
+
+    @property
+    def best_reachable_score(self):
+      """The log prob can only decrease when tokens are added and the length penalty increases with the length,
+      so no extension of this hypothesis can have a better score than its log prob normalized by the penalty of the longest possible length"""
+      return self.tot_log_prob/length_penalty(params['max_dec_steps'] + 1)
+
   # end of the nested class
 
+  def length_penalty(length):
+    if params["length_penalty"] == "gnmt":
+      return ((5. + length) / 6.) ** params["lp_alpha"] # Wu et al. 2016
+    return length # "avg" : average log prob of the tokens
+
+  def banned_tokens(tokens):
+    """Tokens which would repeat an n-gram of the hypothesis (n = no_repeat_ngram_size)"""
+    n = params["no_repeat_ngram_size"]
+    if n <= 0 or len(tokens) < n:
+      return []
+    prefix = tokens[len(tokens)-n+1:]
+    return [tokens[i+n-1] for i in range(len(tokens)-n+1) if tokens[i:i+n-1] == prefix]
+
   # We run the encoder once and then we use the results to decode each time step token
 
   state, enc_outputs = model.call_encoder(batch[0]["enc_input"])
 
+  # The generator softmax can be restricted to the shortlist_size most frequent words (the vocab file is sorted by frequency) and the words of the article
+  # The [UNK], [PAD], [START] and [STOP] ids (0 to 3) are always in the shortlist, otherwise the hypothesises could never be finished
+  shortlist = None
+  if params["shortlist_size"] > 0:
+    special_ids = [vocab.word_to_id(w) for w in [vocab.UNKNOWN_TOKEN, vocab.PAD_TOKEN, vocab.START_DECODING, vocab.STOP_DECODING]]
+    shortlist_ids, _ = tf.unique(tf.concat([special_ids, tf.range(min(params["shortlist_size"], params["vocab_size"])), batch[0]["enc_input"][0]], axis=0))
+    shortlist = model.decoder.gather_shortlist(shortlist_ids) # the projection weights are gathered once per article
+
   # Initial Hypothesises (beam_size many list)
   hyps = [Hypothesis(tokens=[vocab.word_to_id('[START]')], # we initalize all the beam_size hypothesises with the token start
                     log_probs = [0.0], # Initial log prob = 0
                     state = state[0], #initial dec_state (we will use only the first dec_state because they're initially the same)
                     attn_dists=[],
-                    p_gens = [], # we init the coverage vector to zero
+                    p_gens = [],
+                    coverage = tf.zeros(tf.shape(enc_outputs)[1]) if params["is_coverage"] else None, # we init the coverage vector to zero
                     ) for _ in range(params['batch_size'])] # batch_size == beam_size
 
   results = [] # list to hold the top beam_size hypothesises
   steps=0 # initial step
 
-  while steps < params['max_dec_steps'] and len(results) < params['beam_size'] : 
-    latest_tokens = [h.latest_token for h in hyps] # latest token for each hypothesis , shape : [beam_size]
+  while steps < params['max_dec_steps'] and len(results) < params['beam_size'] and hyps : 
+    # the model runs on batch_size rows, the hypothesises removed by the pruning are replaced by copies of the first one (their results are ignored)
+    batch_hyps = hyps + [hyps[0]] * (params['batch_size'] - len(hyps))
+    latest_tokens = [h.latest_token for h in batch_hyps] # latest token for each hypothesis , shape : [beam_size]
     latest_tokens = [t if t in range(params['vocab_size']) else vocab.word_to_id('[UNK]') for t in latest_tokens] # we replace all the oov is by the unknown token
-    states = [h.state for h in hyps] # we collect the last states for each hypothesis
+    states = [h.state for h in batch_hyps] # we collect the last states for each hypothesis
+    prev_coverage = tf.stack([h.coverage for h in batch_hyps], axis=0) if params["is_coverage"] else None
+    banned_ids = [[i, t] for i, h in enumerate(hyps) for t in banned_tokens(h.tokens)]
 
     # we decode the top likely 2 x beam_size tokens tokens at time step t for each hypothesis
-    returns = decode_onestep( batch, enc_outputs, tf.stack(states, axis=0), tf.expand_dims(latest_tokens, axis=1))
+    returns = decode_onestep( batch, enc_outputs, tf.stack(states, axis=0), tf.expand_dims(latest_tokens, axis=1), prev_coverage, banned_ids, shortlist)
     topk_ids, topk_log_probs, new_states, attn_dists , p_gens=  returns['top_k_ids'], returns['top_k_log_probs'], returns['dec_state'], returns['attention_vec'], np.squeeze(returns["p_gen"])
+    new_coverage = returns["coverage"]
     all_hyps = []
     num_orig_hyps = 1 if steps ==0 else len(hyps)
     for i in range(num_orig_hyps):
       h, new_state, attn_dist, p_gen = hyps[i], new_states[i], attn_dists[i], p_gens[i]
+      new_coverage_i = new_coverage[i] if params["is_coverage"] else None
 
       for j in range(params['beam_size']*2):
         # we extend each hypothesis with each of the top k tokens (this gives 2 x beam_size new hypothesises for each of the beam_size old hypothesises)
@@ -99,12 +148,13 @@ def beam_decode(model, batch, vocab, params):
                            log_prob=topk_log_probs[i,j],
                            state = new_state,
                            attn_dist=attn_dist,
-                           p_gen=p_gen)
+                           p_gen=p_gen,
+                           coverage=new_coverage_i)
         all_hyps.append(new_hyp)
 
     # in the following lines, we sort all the hypothesises, and select only the beam_size most likely hypothesises
     hyps = []
-    sorted_hyps = sorted(all_hyps, key=lambda h: h.avg_log_prob, reverse=True)
+    sorted_hyps = sorted(all_hyps, key=lambda h: h.score, reverse=True)
     for h in sorted_hyps:
       if h.latest_token == vocab.word_to_id('[STOP]'):
         if steps >= params['min_dec_steps']:
@@ -116,15 +166,122 @@ def beam_decode(model, batch, vocab, params):
 
     steps += 1
 
+    if results:
+      best_result_score = max(h.score for h in results)
+      if params["beam_prune_threshold"] > 0:
+        # we drop the live hypothesises which are too far behind the best finished one
+        hyps = [h for h in hyps if h.score >= best_result_score - params["beam_prune_threshold"]]
+      if params["beam_early_stopping"] and all(h.best_reachable_score <= best_result_score for h in hyps):
+        break
+
   if len(results)==0:
     results=hyps
 
   # At the end of the loop we return the most likely hypothesis, which holds the most likely ouput sequence, given the input fed to the model
-  hyps_sorted = sorted(results, key=lambda h: h.avg_log_prob, reverse=True)
+  hyps_sorted = sorted(results, key=lambda h: h.score, reverse=True)
   best_hyp = hyps_sorted[0]
+  best_hyp.decode_steps = steps
   best_hyp.abstract = " ".join(Data_Helper.output_to_words(best_hyp.tokens, vocab, batch[0]["article_oovs"][0])[1:-1])
   best_hyp.text = batch[0]["article"].numpy()[0].decode()
   if params["mode"] == "eval":
     best_hyp.real_abstract = batch[1]["abstract"].numpy()[0].decode()
   return best_hyp
 
+
+
+def _tile_example(batch, i, batch_size):
+  """Builds a beam search batch made of batch_size copies of the article i of the batch"""
+  enc_len = batch[0]["enc_len"][i]
+  enc = {k : tf.repeat(v[i:i+1], batch_size, axis=0) for k, v in batch[0].items() if k != "max_oov_len"}
+  enc["enc_input"] = enc["enc_input"][:, :enc_len]
+  enc["extended_enc_input"] = enc["extended_enc_input"][:, :enc_len]
+  enc["max_oov_len"] = batch[0]["max_oov_len"]
+  dec = {k : tf.repeat(v[i:i+1], batch_size, axis=0) for k, v in batch[1].items()}
+  return enc, dec
+
+
+def fast_decode(model, dataset, vocab, params):
+  """Low latency decoding : the articles of a batch are decoded together by a compiled greedy (or top k sampling) loop.
+  If fast_margin > 0, the articles whose average margin between the two most likely words of the final (p_gen mixed) distribution
+  is below fast_margin are decoded again with beam_decode. Yields one Summary per article."""
+
+  # nested class
+  class Summary:
+    """ Class holding the decoding result of one article """
+    def __init__(self, abstract, text, real_abstract, decode_steps, margin, from_beam, latency):
+      self.abstract = abstract
+      self.text = text
+      self.real_abstract = real_abstract
+      self.decode_steps = decode_steps # number of decoded tokens
+      self.margin = margin # average margin between the two most likely words
+      self.from_beam = from_beam # True if the article was sent to beam search
+      self.latency = latency # decoding time of the article in seconds (share of the batch time + beam search time)
+
+  # end of the nested class
+
+  batch_size = params["batch_size"]
+  start_id = vocab.word_to_id(vocab.START_DECODING)
+  stop_id = vocab.word_to_id(vocab.STOP_DECODING)
+  unk_id = vocab.word_to_id(vocab.UNKNOWN_TOKEN)
+  pad_id = vocab.word_to_id(vocab.PAD_TOKEN)
+
+  @tf.function(input_signature=(tf.TensorSpec(shape=[batch_size, None], dtype=tf.int32),
+                               tf.TensorSpec(shape=[batch_size, None], dtype=tf.int32),
+                               tf.TensorSpec(shape=[], dtype=tf.int32)))
+  def decode_batch(enc_inp, enc_extended_inp, batch_oov_len):
+    dec_hidden, enc_output = model.call_encoder(enc_inp)
+    dec_input = tf.fill([batch_size, 1], start_id)
+    coverage = tf.zeros(tf.shape(enc_output)[:2])
+    tokens = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+    finished = tf.zeros([batch_size], dtype=tf.bool)
+    lengths = tf.zeros([batch_size], dtype=tf.int32)
+    margins = tf.zeros([batch_size])
+    for t in tf.range(params["max_dec_steps"]):
+      final_dists, dec_hidden, _, _, _, new_coverage = model(enc_output, dec_hidden, enc_inp, enc_extended_inp, dec_input, batch_oov_len, coverage if params["is_coverage"] else None)
+      if params["is_coverage"]:
+        coverage = new_coverage
+      final_dist = final_dists[:, 0, :] # shape = (batch_size, extended_vsize)
+      # the [STOP] token can't be decoded before min_dec_steps
+      stop_mask = tf.one_hot(stop_id, tf.shape(final_dist)[1]) * tf.cast(t < params["min_dec_steps"], tf.float32)
+      final_dist = final_dist * (1. - stop_mask)
+      top2_probs, top2_ids = tf.nn.top_k(final_dist, k=2)
+      if params["fast_decode"] == "topk":
+        top_probs, top_ids = tf.nn.top_k(final_dist, k=params["top_k"])
+        choices = tf.random.categorical(tf.math.log(top_probs), 1)
+        ids = tf.gather(top_ids, choices, batch_dims=1)[:, 0]
+      else:
+        ids = top2_ids[:, 0]
+      ids = tf.where(finished, pad_id, ids)
+      tokens = tokens.write(t, ids)
+      active = tf.logical_not(finished)
+      margins += (top2_probs[:, 0] - top2_probs[:, 1]) * tf.cast(active, tf.float32)
+      lengths += tf.cast(active, tf.int32)
+      finished = tf.logical_or(finished, tf.equal(ids, stop_id))
+      dec_input = tf.expand_dims(tf.where(ids >= params["vocab_size"], unk_id, ids), 1) # we replace all the oov ids by the unknown token
+      if tf.reduce_all(finished):
+        break
+    return tf.transpose(tokens.stack()), lengths, margins / tf.cast(tf.maximum(lengths, 1), tf.float32)
+
+  t0 = time.time()
+  decode_batch.get_concrete_function()
+  print("Traced the fast decoding loop in {:.2f}s".format(time.time()-t0))
+
+  for batch in dataset:
+    t0 = time.time()
+    tokens, lengths, margins = decode_batch(batch[0]["enc_input"], batch[0]["extended_enc_input"], batch[0]["max_oov_len"])
+    tokens, lengths, margins = tokens.numpy(), lengths.numpy(), margins.numpy()
+    batch_latency = (time.time() - t0) / batch_size
+    for i in range(batch_size):
+      article = batch[0]["article"].numpy()[i].decode()
+      real_abstract = batch[1]["abstract"].numpy()[i].decode()
+      if params["fast_margin"] > 0 and margins[i] < params["fast_margin"]:
+        t1 = time.time()
+        best_hyp = beam_decode(model, _tile_example(batch, i, batch_size), vocab, params)
+        yield Summary(best_hyp.abstract, article, real_abstract, best_hyp.decode_steps, margins[i], True, batch_latency + time.time() - t1)
+        continue
+      ids = tokens[i, :lengths[i]].tolist()
+      if ids and ids[-1] == stop_id:
+        ids = ids[:-1]
+      article_oovs = [w.decode() for w in batch[0]["article_oovs"].numpy()[i]]
+      abstract = " ".join(Data_Helper.output_to_words(ids, vocab, article_oovs))
+      yield Summary(abstract, article, real_abstract, int(lengths[i]), margins[i], False, batch_latency)
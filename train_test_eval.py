@@ -1,51 +1,64 @@
 import tensorflow as tf
 from model import PGN
 from training_helper import train_model
-from test_helper import beam_decode
-from batcher import batcher, Vocab, Data_Helper
-from tqdm import tqdm
-from rouge import Rouge
+from test_helper import beam_decode, fast_decode
+from batcher import batcher, pack_corpus, load_vocab, Data_Helper
+from utils import timer
 import pprint
+import time
 
 def train(params):
 	assert params["mode"].lower() == "train", "change training mode to 'train'"
 
-	tf.compat.v1.logging.info("Building the model ...")
-	model = PGN(params)
+	with timer("Building the model"):
+		model = PGN(params)
+		model.warm_up()
 
-	print("Creating the vocab ...")
-	vocab = Vocab(params["vocab_path"], params["vocab_size"])
-
-	print("Creating the batcher ...")
-	b = batcher(params["data_dir"], vocab, params)
+	with timer("Creating the vocab"):
+		vocab = load_vocab(params["vocab_path"], params["vocab_size"], params["vocab_cache"])
 
 	print("Creating the checkpoint manager")
 	checkpoint_dir = "{}".format(params["checkpoint_dir"])
 	ckpt = tf.train.Checkpoint(step=tf.Variable(0), PGN=model)
 	ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=11)
 
-	ckpt.restore(ckpt_manager.latest_checkpoint)
+	with timer("Restoring the checkpoint"):
+		ckpt.restore(ckpt_manager.latest_checkpoint)
 	if ckpt_manager.latest_checkpoint:
 		print("Restored from {}".format(ckpt_manager.latest_checkpoint))
 	else:
 		print("Initializing from scratch.")
 
+	with timer("Creating the batcher"):
+		b = batcher(params["data_dir"], vocab, params, start_step=int(ckpt.step))
+
 	tf.compat.v1.logging.info("Starting the training ...")
 	train_model(model, b, params, ckpt, ckpt_manager, "output.txt")
  
 
+def pack(params):
+	assert params["pack_dir"], "provide a dir where to save the packed corpus"
+
+	with timer("Creating the vocab"):
+		vocab = load_vocab(params["vocab_path"], params["vocab_size"], params["vocab_cache"])
+
+	print("Packing the corpus ...")
+	pack_corpus(params["data_dir"], params["pack_dir"], vocab, params)
+
+
 def test(params):
 	assert params["mode"].lower() in ["test","eval"], "change training mode to 'test' or 'eval'"
 	assert params["beam_size"] == params["batch_size"], "Beam size must be equal to batch_size, change the params"
 
-	tf.compat.v1.logging.info("Building the model ...")
-	model = PGN(params)
+	with timer("Building the model"):
+		model = PGN(params)
+		model.warm_up()
 
-	print("Creating the vocab ...")
-	vocab = Vocab(params["vocab_path"], params["vocab_size"])
+	with timer("Creating the vocab"):
+		vocab = load_vocab(params["vocab_path"], params["vocab_size"], params["vocab_cache"])
 
-	print("Creating the batcher ...")
-	b = batcher(params["data_dir"], vocab, params)
+	with timer("Creating the batcher"):
+		b = batcher(params["data_dir"], vocab, params)
 
 	print("Creating the checkpoint manager")
 	checkpoint_dir = "{}".format(params["checkpoint_dir"])
@@ -53,14 +66,15 @@ def test(params):
 	ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=11)
 
 	path = params["model_path"] if params["model_path"] else ckpt_manager.latest_checkpoint
-	ckpt.restore(path)
-	print("Model restored")
+	with timer("Restoring the model"):
+		ckpt.restore(path)
 
 	for batch in b:
 		yield  beam_decode(model, batch, vocab, params)
 
 
 def test_and_save(params):
+	from tqdm import tqdm
 	assert params["test_save_dir"], "provide a dir where to save the results"
 	gen = test(params)
 	with tqdm(total=params["num_to_test"],position=0, leave=True) as pbar:
@@ -74,16 +88,87 @@ def test_and_save(params):
 			pbar.update(1)
 
 def evaluate(params):
+	from tqdm import tqdm
+	from rouge import Rouge
 	gen = test(params)
 	reals = []
 	preds = []
+	decode_steps = []
+	with tqdm(total=params["max_num_to_eval"],position=0, leave=True) as pbar:
+		for i in range(params["max_num_to_eval"]):
+			trial = next(gen)
+			reals.append(trial.real_abstract)
+			preds.append(trial.abstract)
+			decode_steps.append(trial.decode_steps)
+			pbar.update(1)
+	r=Rouge()
+	scores = r.get_scores(preds, reals, avg=True)
+	print("\n\n")
+	pprint.pprint(scores)
+	print("Average number of decoding steps per article : {:.2f}".format(sum(decode_steps)/len(decode_steps)))
+
+def fast_evaluate(params):
+	from tqdm import tqdm
+	from rouge import Rouge
+	assert params["mode"].lower() == "fast", "change training mode to 'fast'"
+	if params["fast_margin"] > 0 or params["compare_beam"]:
+		assert params["beam_size"] == params["batch_size"], "Beam size must be equal to batch_size to use beam search, change the params"
+
+	with timer("Building the model"):
+		model = PGN(params)
+		model.warm_up()
+
+	with timer("Creating the vocab"):
+		vocab = load_vocab(params["vocab_path"], params["vocab_size"], params["vocab_cache"])
+
+	with timer("Creating the batcher"):
+		b = batcher(params["data_dir"], vocab, params)
+
+	print("Creating the checkpoint manager")
+	checkpoint_dir = "{}".format(params["checkpoint_dir"])
+	ckpt = tf.train.Checkpoint(step=tf.Variable(0), PGN=model)
+	ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=11)
+
+	path = params["model_path"] if params["model_path"] else ckpt_manager.latest_checkpoint
+	with timer("Restoring the model"):
+		ckpt.restore(path)
+
+	gen = fast_decode(model, b, vocab, params)
+	reals = []
+	preds = []
+	latencies = []
+	num_beam = 0
 	with tqdm(total=params["max_num_to_eval"],position=0, leave=True) as pbar:
 		for i in range(params["max_num_to_eval"]):
 			trial = next(gen)
 			reals.append(trial.real_abstract)
 			preds.append(trial.abstract)
+			latencies.append(trial.latency)
+			num_beam += int(trial.from_beam)
 			pbar.update(1)
 	r=Rouge()
 	scores = r.get_scores(preds, reals, avg=True)
 	print("\n\n")
-	pprint.pprint(scores)
\ No newline at end of file
+	pprint.pprint(scores)
+	print("Fast decoding ({}) : {:.4f}s per article, {}/{} articles sent to beam search".format(params["fast_decode"], sum(latencies)/len(latencies), num_beam, len(latencies)))
+
+	if params["compare_beam"]:
+		# the restored model is reused, and only the beam_decode calls are timed, as the fast latency excludes the startup and the tracing
+		beam_params = dict(params, mode="eval")
+		beam_batches = iter(batcher(params["data_dir"], vocab, beam_params))
+		beam_reals = [] # the eval batcher may read the articles in another order than the fast one
+		beam_preds = []
+		beam_latencies = []
+		with tqdm(total=params["max_num_to_eval"],position=0, leave=True) as pbar:
+			for i in range(params["max_num_to_eval"]):
+				batch = next(beam_batches)
+				t0 = time.time()
+				trial = beam_decode(model, batch, vocab, beam_params)
+				beam_latencies.append(time.time()-t0)
+				beam_reals.append(trial.real_abstract)
+				beam_preds.append(trial.abstract)
+				pbar.update(1)
+		beam_latency = sum(beam_latencies)/len(beam_latencies)
+		print("\n\nBeam search :")
+		pprint.pprint(r.get_scores(beam_preds, beam_reals, avg=True))
+		print("Beam search : {:.4f}s per article".format(beam_latency))
@@ -1,5 +1,6 @@
 import tensorflow as tf
 import time
+from utils import peak_memory_mb
 
 
 def train_model(model, dataset, params, ckpt, ckpt_manager, out_file):
@@ -17,6 +18,12 @@ def train_model(model, dataset, params, ckpt, ckpt_manager, out_file):
     loss_ = tf.reduce_sum(loss_, axis=-1)/dec_lens # we have to make sure no empty abstract is being used otherwise dec_lens may contain null values
     return tf.reduce_mean(loss_)
   
+  def coverage_loss_function(real, coverage_losses):
+    # coverage_losses shape = (batch_size, dec_len), sum(min(attention, coverage)) of each decoder step
+    mask = tf.cast(tf.math.logical_not(tf.math.equal(real, 1)), dtype=coverage_losses.dtype)
+    dec_lens = tf.reduce_sum(mask, axis=-1)
+    return tf.reduce_mean(tf.reduce_sum(coverage_losses * mask, axis=-1)/dec_lens)
+  
   @tf.function(input_signature=(tf.TensorSpec(shape=[params["batch_size"], None], dtype=tf.int32),
                                tf.TensorSpec(shape=[params["batch_size"], None], dtype=tf.int32),
                                tf.TensorSpec(shape=[params["batch_size"], params["max_dec_len"]], dtype=tf.int32),
@@ -24,30 +31,50 @@ def train_model(model, dataset, params, ckpt, ckpt_manager, out_file):
                                tf.TensorSpec(shape=[], dtype=tf.int32)))
   def train_step(enc_inp, enc_extended_inp, dec_inp, dec_tar, batch_oov_len):
     loss = 0
+    cov_loss = tf.constant(0.)
 
     with tf.GradientTape() as tape:
       enc_hidden, enc_output = model.call_encoder(enc_inp)
-      predictions, _ = model(enc_output, enc_hidden, enc_inp, enc_extended_inp, dec_inp, batch_oov_len)
+      predictions, _, coverage_losses = model(enc_output, enc_hidden, enc_inp, enc_extended_inp, dec_inp, batch_oov_len)
       loss = loss_function(dec_tar, predictions)
+      if params["is_coverage"]:
+        cov_loss = coverage_loss_function(dec_tar, coverage_losses)
+        loss += params["cov_loss_wt"] * cov_loss
     variables = model.encoder.trainable_variables + model.attention.trainable_variables + model.decoder.trainable_variables + model.pointer.trainable_variables
     gradients = tape.gradient(loss, variables)
     optimizer.apply_gradients(zip(gradients, variables))
-    return loss
+    return loss, cov_loss
+  
   
   
+  # tracing the train step before the first batch is read (the variables are created by the model warm up)
+  t0 = time.time()
+  train_step.get_concrete_function()
+  print("Traced the train step in {:.2f}s".format(time.time()-t0))
   
+  total_time = 0.
+  num_steps = 0
   try:
     f = open(out_file,"w+")
     for batch in dataset:
+      step = int(ckpt.step)
       t0 = time.time()
-      loss = train_step(batch[0]["enc_input"], batch[0]["extended_enc_input"], batch[1]["dec_input"], batch[1]["dec_target"], batch[0]["max_oov_len"])
-      print('Step {}, time {:.4f}, Loss {:.4f}'.format(int(ckpt.step),
-                                                       time.time()-t0,
-                                                       loss.numpy()))
-      f.write('Step {}, time {:.4f}, Loss {:.4f}\n'.format(int(ckpt.step),
-                                                       time.time()-t0,
-                                                       loss.numpy()))
-      if int(ckpt.step) == params["max_steps"]:
+      loss, cov_loss = train_step(batch[0]["enc_input"], batch[0]["extended_enc_input"], batch[1]["dec_input"], batch[1]["dec_target"], batch[0]["max_oov_len"])
+      # ckpt.step counts the batches already trained, so a checkpoint saved now is resumed at the next batch
+      ckpt.step.assign_add(1)
+      step_time = time.time()-t0
+      log = 'Step {}, time {:.4f}, Loss {:.4f}'.format(step, step_time, loss.numpy())
+      total_time += step_time
+      num_steps += 1
+      if params["is_coverage"]:
+        # cost of the coverage : compare the step time and the peak memory with a run without --is_coverage
+        log += ', Coverage loss {:.4f}'.format(cov_loss.numpy())
+      peak_memory = peak_memory_mb()
+      if peak_memory is not None:
+        log += ', Peak memory {:.1f}MB'.format(peak_memory)
+      print(log)
+      f.write(log + '\n')
+      if int(ckpt.step) >= params["max_steps"]:
         ckpt_manager.save(checkpoint_number=int(ckpt.step))
         print("Saved checkpoint for step {}".format(int(ckpt.step)))
         f.close()
@@ -55,11 +82,12 @@ def train_model(model, dataset, params, ckpt, ckpt_manager, out_file):
       if int(ckpt.step) % params["checkpoints_save_steps"] ==0 :
         ckpt_manager.save(checkpoint_number=int(ckpt.step))
         print("Saved checkpoint for step {}".format(int(ckpt.step)))
-      ckpt.step.assign_add(1)
+        print("Average step time over {} steps : {:.4f}s".format(num_steps, total_time/num_steps))
     f.close()
       
         
   except KeyboardInterrupt:
+    # an interruption between the end of train_step and the step increment leaves one trained batch uncounted, it is trained again on restore
     ckpt_manager.save(int(ckpt.step))
     print("Saved checkpoint for step {}".format(int(ckpt.step)))
     f.close()
@@ -1,6 +1,8 @@
 import tensorflow as tf
 import os
 import logging
+import time
+import contextlib
 
 def define_logger(log_file):
   tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
@@ -17,11 +19,29 @@ def define_logger(log_file):
   fh.setFormatter(formatter)
   log.addHandler(fh)
 
-def _calc_final_dist( _enc_batch_extend_vocab, vocab_dists, attn_dists, p_gens, batch_oov_len, vocab_size, batch_size):
+@contextlib.contextmanager
+def timer(phase):
+  """Prints the duration of a startup phase"""
+  print("{} ...".format(phase))
+  t0 = time.time()
+  yield
+  print("{} : done in {:.2f}s".format(phase, time.time()-t0))
+
+def peak_memory_mb(reset=True):
+  """Peak memory allocated by tensorflow on the first GPU since the last reset, in MB (None without GPU)"""
+  if not tf.config.list_physical_devices("GPU"):
+    return None
+  peak = tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2**20
+  if reset:
+    tf.config.experimental.reset_memory_stats("GPU:0")
+  return peak
+
+def _calc_final_dist( _enc_batch_extend_vocab, vocab_dists, attn_dists, p_gens, batch_oov_len, vocab_size, batch_size, shortlist_ids=None):
   """Calculate the final distribution, for the pointer-generator model
   Args:
   vocab_dists: The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays. The words are in the order they appear in the vocabulary file.
   attn_dists: The attention distributions. List length max_dec_steps of (batch_size, attn_len) arrays
+  shortlist_ids: If not None, (shortlist_size) array of the vocabulary ids the vocab_dists are restricted to, vocab_dists are then (batch_size, shortlist_size) arrays.
   Returns:
   final_dists: The final distributions. List length max_dec_steps of (batch_size, extended_vsize) arrays.
   """
@@ -29,10 +49,18 @@ def _calc_final_dist( _enc_batch_extend_vocab, vocab_dists, attn_dists, p_gens,
   vocab_dists = [p_gen * dist for (p_gen,dist) in zip(p_gens, vocab_dists)]
   attn_dists = [(1-p_gen) * dist for (p_gen,dist) in zip(p_gens, attn_dists)]
 
-  # Concatenate some zeros to each vocabulary dist, to hold the probabilities for in-article OOV words
   extended_vsize = vocab_size + batch_oov_len # the maximum (over the batch) size of the extended vocabulary
-  extra_zeros = tf.zeros((batch_size, batch_oov_len ))
-  vocab_dists_extended = [tf.concat(axis=1, values=[dist, extra_zeros]) for dist in vocab_dists] # list length max_dec_steps of shape (batch_size, extended_vsize)
+  shape = [batch_size, extended_vsize]
+  if shortlist_ids is None:
+    # Concatenate some zeros to each vocabulary dist, to hold the probabilities for in-article OOV words
+    extra_zeros = tf.zeros((batch_size, batch_oov_len ))
+    vocab_dists_extended = [tf.concat(axis=1, values=[dist, extra_zeros]) for dist in vocab_dists] # list length max_dec_steps of shape (batch_size, extended_vsize)
+  else:
+    # Project the shortlisted words probabilities onto their vocabulary ids, the other words get a zero probability
+    shortlist_size = tf.shape(shortlist_ids)[0]
+    shortlist_batch_nums = tf.tile(tf.expand_dims(tf.range(0, limit=batch_size), 1), [1, shortlist_size]) # shape (batch_size, shortlist_size)
+    shortlist_indices = tf.stack( (shortlist_batch_nums, tf.tile(tf.expand_dims(shortlist_ids, 0), [batch_size, 1])), axis=2) # shape (batch_size, shortlist_size, 2)
+    vocab_dists_extended = [tf.scatter_nd(shortlist_indices, dist, shape) for dist in vocab_dists] # list length max_dec_steps of shape (batch_size, extended_vsize)
 
   # Project the values in the attention distributions onto the appropriate entries in the final distributions
   # This means that if a_i = 0.1 and the ith encoder word is w, and w has index 500 in the vocabulary, then we add 0.1 onto the 500th entry of the final distribution
@@ -43,7 +71,6 @@ def _calc_final_dist( _enc_batch_extend_vocab, vocab_dists, attn_dists, p_gens,
   attn_len = tf.shape(_enc_batch_extend_vocab)[1] # number of states we attend over
   batch_nums = tf.tile(batch_nums, [1, attn_len]) # shape (batch_size, attn_len)
   indices = tf.stack( (batch_nums, _enc_batch_extend_vocab), axis=2) # shape (batch_size, enc_t, 2)
-  shape = [batch_size, extended_vsize]
   attn_dists_projected = [tf.scatter_nd(indices, copy_dist, shape) for copy_dist in attn_dists] # list length max_dec_steps (batch_size, extended_vsize)
 
   # Add the vocab distributions and the copy distributions together to get the final distributions